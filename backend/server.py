@@ -1,16 +1,24 @@
 from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState
+from starlette.background import BackgroundTask
+from anyio import to_thread
 from dotenv import load_dotenv
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel
-from openai import OpenAI
-import io
-import json
-import websockets
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import orjson
+import msgspec
+from websockets.asyncio.client import connect as ws_connect
+import httpx
 import asyncio
+import ssl
+import traceback
+from functools import lru_cache
+from contextlib import AsyncExitStack, asynccontextmanager
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -19,76 +27,125 @@ env_path = ROOT_DIR / '.env'
 load_dotenv(env_path, override=False)
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
+# Give this module a single handler of its own and stop propagation to root,
+# so each record is formatted once
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(_log_handler)
+logger.propagate = False
 
 # Check if .env file exists
 if env_path.exists():
-    logger.info(f"✅ Found .env file at: {env_path}")
+    logger.info("✅ Found .env file at: %s", env_path)
 else:
-    logger.warning(f"⚠️  .env file not found at: {env_path}")
+    logger.warning("⚠️  .env file not found at: %s", env_path)
 
-# OpenAI client
-api_key = os.environ.get('OPENAI_API_KEY')
-if not api_key:
-    # Try reading directly from file as fallback
-    if env_path.exists():
-        try:
-            # Try multiple encodings
-            for encoding in ['utf-8', 'utf-8-sig', 'latin-1']:
-                try:
-                    with open(env_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                        # Try splitting by both \n and \r\n
-                        lines = content.replace('\r\n', '\n').split('\n')
-                        for line in lines:
-                            line = line.strip()
-                            # Skip comments and empty lines
-                            if line and not line.startswith('#'):
-                                if line.startswith('OPENAI_API_KEY='):
-                                    api_key = line.split('=', 1)[1].strip().strip('"').strip("'")
-                                    if api_key:
-                                        logger.info(f"✅ Loaded API key from .env file (encoding: {encoding})")
-                                        break
-                        if api_key:
-                            break
-                except UnicodeDecodeError:
+# Realtime API model used by both the session endpoint and the WebSocket proxy
+MODEL_NAME = "gpt-4o-realtime-preview-2024-10-01"
+OPENAI_HOST = "api.openai.com"
+
+# TLS context for Realtime upstream sockets, built once because creating one
+# loads the CA bundle from disk
+SSL_CTX = ssl.create_default_context()
+
+# OpenAI API key
+@lru_cache(maxsize=1)
+def _load_api_key():
+    """Resolve OPENAI_API_KEY from the environment, falling back to the .env file.
+
+    The result is memoized; call _load_api_key.cache_clear() to force a reload.
+    """
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if api_key:
+        return api_key
+    if not env_path.exists():
+        return None
+    try:
+        # utf-8-sig also strips a BOM left behind by some Windows editors
+        with open(env_path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                # Skip comments and empty lines
+                if not line or line.startswith('#'):
                     continue
-        except Exception as e:
-            logger.error(f"Error reading .env file: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-    
-    # Only show warning if we couldn't load from .env file either
-    if not api_key:
-        logger.warning("⚠️  OPENAI_API_KEY not found in environment variables or .env file!")
-    
+                key, _, value = line.partition('=')
+                if key.strip() == 'OPENAI_API_KEY':
+                    value = value.strip().strip('"').strip("'")
+                    if value:
+                        logger.info("✅ Loaded API key from .env file")
+                        return value
+    except Exception as e:
+        logger.error("Error reading .env file: %s", e)
+        logger.error(traceback.format_exc())
+    return None
+
+# OpenAI client, created per app lifespan together with its connection pool
+openai_client = None
+
+api_key = _load_api_key()
 if not api_key:
     logger.error("❌ OPENAI_API_KEY still not found! Please check backend/.env file")
-    logger.error(f"File exists: {env_path.exists()}, Path: {env_path}")
+    logger.error("File exists: %s, Path: %s", env_path.exists(), env_path)
     if env_path.exists():
         try:
             with open(env_path, 'rb') as f:
                 raw_content = f.read()
-                logger.error(f"File content (first 100 bytes): {raw_content[:100]}")
+                logger.error("File content (first 100 bytes): %s", raw_content[:100])
         except:
             pass
-    openai_client = None
 else:
     # Mask the key for logging (only show first 7 and last 4 characters)
     masked_key = f"{api_key[:7]}...{api_key[-4:]}" if len(api_key) > 11 else "***"
-    logger.info(f"✅ OpenAI API key loaded: {masked_key} (length: {len(api_key)})")
+    logger.info("✅ OpenAI API key loaded: %s (length: %d)", masked_key, len(api_key))
+
+# Realtime session config never changes per request, so build it once at startup
+REALTIME_SESSION_PAYLOAD = None
+
+# Starlette runs blocking file I/O (multipart spooling, reads of uploads that
+# rolled over to disk) on the anyio threadpool, which defaults to 40 threads
+THREADPOOL_SIZE = 100
+
+@asynccontextmanager
+async def lifespan(app):
+    global openai_client, REALTIME_SESSION_PAYLOAD
+    api_key = _load_api_key()
+    http_client = None
+    if api_key:
+        # Shared connection pool for every outbound OpenAI HTTP call, so chat/TTS/Whisper
+        # requests reuse warm TLS connections (multiplexed over HTTP/2) instead of reconnecting
+        http_client = DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        try:
+            openai_client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+        except Exception as e:
+            logger.error("Error initializing OpenAI client: %s", e)
+    if openai_client:
+        REALTIME_SESSION_PAYLOAD = {"apiKey": api_key, "model": MODEL_NAME}
+    
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    
+    # Resolve the OpenAI host ahead of the first Realtime session so it doesn't pay the DNS round trip
     try:
-        openai_client = OpenAI(api_key=api_key)
-    except Exception as e:
-        logger.error(f"Error initializing OpenAI client: {e}")
-        openai_client = None
+        await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(OPENAI_HOST, 443), timeout=2)
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("Could not resolve %s at startup: %s", OPENAI_HOST, str(e) or "timed out")
+    
+    yield
+    
+    openai_client = None
+    REALTIME_SESSION_PAYLOAD = None
+    if http_client:
+        await http_client.aclose()
 
 # Create FastAPI app
-app = FastAPI(title="Voice Bot API", version="1.0.0")
+app = FastAPI(title="Voice Bot API", version="1.0.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Setup CORS - allow all origins for local file access
 app.add_middleware(
@@ -102,6 +159,16 @@ app.add_middleware(
 # Create API router
 api_router = APIRouter(prefix="/api")
 
+# System prompt shared by the chat endpoints; the OpenAI client only reads it
+SYSTEM_MSG = {"role": "system", "content": "You are a helpful AI assistant. Keep responses concise and conversational."}
+
+# Server-sent event framing for chat/stream
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+# Response headers for /speak; Starlette copies them into each response
+TTS_HEADERS = {"Content-Disposition": "attachment; filename=speech.mp3"}
+
 # Request/Response Models
 class ChatMessage(BaseModel):
     text: str
@@ -117,35 +184,9 @@ async def root():
 @api_router.get("/realtime-session")
 async def get_realtime_session():
     """Get configuration for Realtime API session"""
-    if not openai_client:
+    if REALTIME_SESSION_PAYLOAD is None:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    
-    # Get API key
-    api_key = None
-    if openai_client and hasattr(openai_client, '_client'):
-        if hasattr(openai_client._client, 'api_key'):
-            api_key = openai_client._client.api_key
-    if not api_key:
-        api_key = os.environ.get('OPENAI_API_KEY')
-    if not api_key:
-        if env_path.exists():
-            try:
-                with open(env_path, 'r', encoding='utf-8-sig') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith('OPENAI_API_KEY='):
-                            api_key = line.split('=', 1)[1].strip().strip('"').strip("'")
-                            break
-            except:
-                pass
-    
-    if not api_key:
-        raise HTTPException(status_code=500, detail="API key not available")
-    
-    return {
-        "apiKey": api_key,
-        "model": "gpt-4o-realtime-preview-2024-10-01"
-    }
+    return REALTIME_SESSION_PAYLOAD
 
 @api_router.post("/transcribe")
 async def transcribe_audio(file: UploadFile = File(...)):
@@ -153,27 +194,26 @@ async def transcribe_audio(file: UploadFile = File(...)):
     if not openai_client:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in backend/.env")
     try:
-        # Read audio file
+        filename = file.filename or "audio.webm"
+        
+        # Starlette has already spooled the upload; read it once as bytes. A file
+        # object would be probed with fileno() by httpx, forcing a disk rollover
         audio_data = await file.read()
         file_size = len(audio_data)
-        file_type = file.content_type or "unknown"
-        filename = file.filename or "audio.webm"
         
-        logger.info(f"Received audio file: {filename}, size: {file_size} bytes, type: {file_type}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Received audio file: %s, size: %d bytes, type: %s", filename, file_size, file.content_type or "unknown")
         
         # Validate file size
         if file_size < 1000:
-            logger.warning(f"Audio file too small: {file_size} bytes")
+            logger.warning("Audio file too small: %d bytes", file_size)
             raise HTTPException(status_code=400, detail=f"Audio file too small ({file_size} bytes). Please record for longer.")
         
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = filename
-        
         # Transcribe using Whisper with language hint for better accuracy
         # Remove prompt as it might interfere with very short recordings
-        transcript = openai_client.audio.transcriptions.create(
+        transcript = await openai_client.audio.transcriptions.create(
             model="whisper-1",
-            file=audio_file,
+            file=(filename, audio_data, file.content_type),
             language="en",  # Language hint - change to your language if different
             temperature=0.0,  # More deterministic, less creative
             response_format="text"  # Explicitly request text format
@@ -185,7 +225,7 @@ async def transcribe_audio(file: UploadFile = File(...)):
         else:
             transcription_text = transcript.text.strip() if hasattr(transcript, 'text') else str(transcript).strip()
         
-        logger.info(f"📝 Transcription result: '{transcription_text}' (length: {len(transcription_text)}, file_size: {file_size})")
+        logger.info("📝 Transcription result: '%s' (length: %d, file_size: %d)", transcription_text, len(transcription_text), file_size)
         
         if not transcription_text or len(transcription_text) < 1:
             logger.warning("Empty transcription received from Whisper")
@@ -193,7 +233,7 @@ async def transcribe_audio(file: UploadFile = File(...)):
         
         return {"transcription": transcription_text}
     except Exception as e:
-        logger.error(f"Transcription error: {e}")
+        logger.error("Transcription error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/chat", response_model=ChatResponse)
@@ -202,10 +242,10 @@ async def chat(message: ChatMessage):
     if not openai_client:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in backend/.env")
     try:
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "You are a helpful AI assistant. Keep responses concise and conversational."},
+                SYSTEM_MSG,
                 {"role": "user", "content": message.text}
             ]
         )
@@ -213,7 +253,7 @@ async def chat(message: ChatMessage):
         bot_response = response.choices[0].message.content
         return ChatResponse(response=bot_response)
     except Exception as e:
-        logger.error(f"Chat error: {e}")
+        logger.error("Chat error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/chat/stream")
@@ -224,22 +264,22 @@ async def chat_stream(message: ChatMessage):
     
     async def generate():
         try:
-            stream = openai_client.chat.completions.create(
+            stream = await openai_client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant. Keep responses concise and conversational."},
+                    SYSTEM_MSG,
                     {"role": "user", "content": message.text}
                 ],
                 stream=True
             )
             
-            for chunk in stream:
+            async for chunk in stream:
                 if chunk.choices[0].delta.content is not None:
                     content = chunk.choices[0].delta.content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
+                    yield SSE_PREFIX + orjson.dumps({"content": content}) + SSE_SUFFIX
         except Exception as e:
-            logger.error(f"Chat stream error: {e}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            logger.error("Chat stream error: %s", e)
+            yield SSE_PREFIX + orjson.dumps({"error": str(e)}) + SSE_SUFFIX
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -249,27 +289,50 @@ async def text_to_speech(message: ChatMessage):
     if not openai_client:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured. Please set OPENAI_API_KEY in backend/.env")
     try:
-        response = openai_client.audio.speech.create(
-            model="tts-1",
-            voice="alloy",
-            input=message.text
+        # Open the upstream stream here so API errors still surface as a 500;
+        # the exit stack keeps it open until the client has read the last chunk
+        stack = AsyncExitStack()
+        response = await stack.enter_async_context(
+            openai_client.audio.speech.with_streaming_response.create(
+                model="tts-1",
+                voice="alloy",
+                input=message.text
+            )
         )
         
-        # Stream the audio response
-        audio_data = io.BytesIO(response.content)
+        async def stream_audio():
+            async with stack:
+                async for chunk in response.iter_bytes(chunk_size=4096):
+                    yield chunk
         
+        # Stream the audio response
         return StreamingResponse(
-            audio_data,
+            stream_audio(),
             media_type="audio/mpeg",
-            headers={"Content-Disposition": "attachment; filename=speech.mp3"}
+            headers=TTS_HEADERS,
+            # Also close the upstream if the client disconnects before the body starts
+            background=BackgroundTask(stack.aclose)
         )
     except Exception as e:
-        logger.error(f"TTS error: {e}")
+        logger.error("TTS error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Include router
 app.include_router(api_router)
 
+# Realtime events are compact JSON with "type" first; used to fast-path audio frames
+AUDIO_DELTA_MARKER = '"type":"response.audio.delta"'
+# Max frames buffered between OpenAI and a slow client before upstream reads pause
+OUTBOUND_QUEUE_SIZE = 64
+
+class _RealtimeEventType(msgspec.Struct):
+    type: str = 'unknown'
+
+_event_type_decoder = msgspec.json.Decoder(_RealtimeEventType)
+
+class _ProxyClosed(Exception):
+    """Raised by a proxy direction once its side of the connection has ended"""
+
 # WebSocket endpoint for Realtime API
 @app.websocket("/ws/realtime")
 async def websocket_realtime(websocket: WebSocket):
@@ -282,90 +345,112 @@ async def websocket_realtime(websocket: WebSocket):
     
     openai_ws = None
     try:
-        # Get API key
-        api_key = None
-        if openai_client and hasattr(openai_client, '_client'):
-            # Try to get from the OpenAI client's internal client
-            if hasattr(openai_client._client, 'api_key'):
-                api_key = openai_client._client.api_key
-        if not api_key:
-            api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            # Read directly from .env file
-            if env_path.exists():
-                try:
-                    with open(env_path, 'r', encoding='utf-8-sig') as f:
-                        for line in f:
-                            line = line.strip()
-                            if line.startswith('OPENAI_API_KEY='):
-                                api_key = line.split('=', 1)[1].strip().strip('"').strip("'")
-                                break
-                except:
-                    pass
-        
+        api_key = _load_api_key()
         if not api_key:
             await websocket.close(code=1008, reason="API key not available")
             return
         
         # Connect to OpenAI Realtime API
         # OpenAI Realtime API endpoint
-        openai_ws_url = "wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01"
+        openai_ws_url = f"wss://{OPENAI_HOST}/v1/realtime?model={MODEL_NAME}"
         headers = {
             "Authorization": f"Bearer {api_key}",
             "OpenAI-Beta": "realtime=v1"
         }
         
-        async with websockets.connect(openai_ws_url, extra_headers=headers) as openai_ws:
+        async with ws_connect(
+            openai_ws_url,
+            additional_headers=headers,
+            ssl=SSL_CTX,
+            max_size=None,
+            compression=None,
+            ping_interval=20,
+            ping_timeout=10
+        ) as openai_ws:
             logger.info("Connected to OpenAI Realtime API")
             
             # Forward messages from client to OpenAI
             async def client_to_openai():
                 try:
                     while True:
-                        data = await websocket.receive_text()
-                        logger.debug(f"Client->OpenAI: {data[:100]}...")  # Log first 100 chars
+                        # Take the raw ASGI frame so text and binary frames are forwarded as-is
+                        frame = await websocket.receive()
+                        if frame["type"] == "websocket.disconnect":
+                            raise WebSocketDisconnect(frame.get("code", 1000))
+                        data = frame.get("text")
+                        if data is None:
+                            data = frame["bytes"]
+                        logger.debug("Client->OpenAI: %.100s...", data)  # Log first 100 chars
                         await openai_ws.send(data)
                 except WebSocketDisconnect:
                     logger.info("Client disconnected")
                 except Exception as e:
-                    logger.error(f"Error forwarding client->openai: {e}")
+                    logger.error("Error forwarding client->openai: %s", e)
+                raise _ProxyClosed()
+            
+            # Frames read from OpenAI wait here for the browser, so a briefly slow client
+            # doesn't stall upstream reads; the bound applies backpressure if it stays slow
+            outbound = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
             
-            # Forward messages from OpenAI to client
-            async def openai_to_client():
+            # Read messages from OpenAI into the outbound queue
+            async def openai_reader():
                 try:
                     async for message in openai_ws:
-                        logger.debug(f"OpenAI->Client: {message[:100]}...")  # Log first 100 chars
-                        # Log message types to debug
+                        if isinstance(message, bytes):
+                            await outbound.put(message)
+                            continue
+                        
+                        # Audio deltas dominate the stream, so forward them without inspection
+                        if message.find(AUDIO_DELTA_MARKER, 0, 128) != -1:
+                            await outbound.put(message)
+                            continue
+                        
+                        logger.debug("OpenAI->Client: %.100s...", message)  # Log first 100 chars
+                        # Decode only the "type" field; the rest of the event is skipped
                         try:
-                            msg_json = json.loads(message)
-                            msg_type = msg_json.get('type', 'unknown')
-                            logger.info(f"📨 Received message type: {msg_type}")
-                            
-                            # Log specific important messages
-                            if msg_type == 'error':
-                                logger.error(f"❌ Error from OpenAI: {msg_json}")
-                            elif msg_type == 'response.created':
-                                logger.info(f"✅ Response created!")
-                            elif msg_type == 'response.audio.started':
-                                logger.info(f"🎵 Audio response started!")
-                            elif msg_type == 'response.audio.delta':
-                                logger.debug(f"🎵 Audio delta received")
-                            elif msg_type == 'response.done':
-                                logger.info(f"✅ Response done!")
-                        except Exception as parse_error:
-                            logger.debug(f"Could not parse message as JSON: {parse_error}")
-                        await websocket.send_text(message)
+                            msg_type = _event_type_decoder.decode(message).type
+                        except msgspec.DecodeError:
+                            msg_type = 'unknown'
+                        logger.info("📨 Received message type: %s", msg_type)
+                        
+                        # Log specific important messages
+                        if msg_type == 'error':
+                            logger.error("❌ Error from OpenAI: %s", message)
+                        elif msg_type == 'response.created':
+                            logger.info("✅ Response created!")
+                        elif msg_type == 'response.audio.started':
+                            logger.info("🎵 Audio response started!")
+                        elif msg_type == 'response.done':
+                            logger.info("✅ Response done!")
+                        await outbound.put(message)
                 except Exception as e:
-                    logger.error(f"Error forwarding openai->client: {e}")
+                    logger.error("Error reading from openai: %s", e)
+                # Let the writer flush what is already queued before it shuts down
+                await outbound.put(None)
             
-            # Run both forwarding tasks concurrently
-            await asyncio.gather(
-                client_to_openai(),
-                openai_to_client()
-            )
+            # Write queued OpenAI messages to the client
+            async def client_writer():
+                try:
+                    while (message := await outbound.get()) is not None:
+                        if isinstance(message, bytes):
+                            await websocket.send_bytes(message)
+                        else:
+                            await websocket.send_text(message)
+                except Exception as e:
+                    logger.error("Error forwarding openai->client: %s", e)
+                raise _ProxyClosed()
+            
+            # Run both forwarding tasks; whichever side ends first tears down the other
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(client_to_openai())
+                    tg.create_task(openai_reader())
+                    tg.create_task(client_writer())
+            except* _ProxyClosed:
+                pass
             
     except Exception as e:
-        logger.error(f"WebSocket error: {e}")
+        logger.error("WebSocket error: %s", e)
         try:
             await websocket.close(code=1011, reason=str(e))
         except:
@@ -376,8 +461,18 @@ async def websocket_realtime(websocket: WebSocket):
                 await openai_ws.close()
             except:
                 pass
+        # If OpenAI hung up first, let the browser know the session is over
+        if (websocket.application_state == WebSocketState.CONNECTED
+                and websocket.client_state == WebSocketState.CONNECTED):
+            try:
+                await websocket.close()
+            except:
+                pass
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop is not available on Windows; fall back to the stock asyncio loop there
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop, http="httptools", ws="websockets")
 